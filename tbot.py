@@ -1,15 +1,22 @@
 import os
+import asyncio
+import hashlib
+import heapq
 import logging
+import time
+from collections import OrderedDict
 from io import BytesIO
 from pathlib import Path
 import re # For sanitizing voice names
+import sqlite3
 
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Bot, Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
     ContextTypes,
 )
@@ -22,14 +29,43 @@ if not BOT_TOKEN:
 
 BASE_DIR = Path(__file__).resolve().parent
 VOICE_DIR = BASE_DIR / "voices"
+_VOICE_DIR_PREFIX = os.path.join(VOICE_DIR, "") # VOICE_DIR with a trailing separator, for building file paths
 DEFAULT_VOICE_NAME = "default" # A conceptual default, or ensure 'default.wav' exists
+VOICE_DATA_CACHE_BYTES = 64 * 1024 * 1024 # Max total size of voice recordings kept in memory
+MISSING_VOICES_CACHE_SIZE = 1000 # Max number of names remembered as not being voices
+PENDING_UPLOAD_TTL = 600 # Seconds a /newvoice request waits for its audio before it's dropped
+USER_DATA_IDLE_TTL = 30 * 24 * 3600 # Seconds without any update after which a user's state is dropped
+USER_DATA_MAX_USERS = 100_000 # Max users whose state is kept; the least recently active are dropped first
+USER_DATA_SWEEP_INTERVAL = 600 # Seconds between sweep_user_data() runs
+VOICE_DIR_CHECK_INTERVAL = 1.0 # Min seconds between checks of VOICE_DIR for voice files added/removed by hand
+
+# Voice file extension, and the spellings recognised when listing VOICE_DIR
+_WAV_SUFFIX = ".wav"
+_WAV_SUFFIXES = (_WAV_SUFFIX, _WAV_SUFFIX.upper())
+
+# Mime types accepted for voices sent as documents
+WAV_MIME_TYPES = frozenset(("audio/wav", "audio/x-wav", "audio/wave"))
 
 # Callback data prefixes
 CALLBACK_PREFIX_VOICE = "select_voice:"
 
-# --- State (in-memory, could be moved to context.bot_data or a database for persistence) ---
-user_selected_voice = {}  # {user_id: voice_name}
-awaiting_voice_upload = {} # {user_id: voice_name_to_save}
+# context.user_data keys (PTB keeps one dict per user)
+USER_DATA_VOICE = "voice" # Selected voice name
+USER_DATA_AWAITING = "awaiting_voice" # (voice name, expiry timestamp) for the next audio upload
+USER_DATA_LAST_SEEN = "last_seen" # Timestamp of the user's latest update, for sweep_user_data()
+
+# Anything that isn't alphanumeric, underscore or hyphen is stripped from voice names
+_SANITIZE_RE = re.compile(r'[^\w\-]')
+
+# --- State (in-memory caches; per-user state lives in context.user_data, ready for a PTB persistence backend) ---
+_voice_index: sqlite3.Connection | None = None # Opened by open_voice_index()
+_voices_cache = {"signature": None, "checked_at": 0.0, "voices": None} # Sorted names from the index; see _voice_dir_signature()
+_missing_voices = {} # {voice_name: None} known not to be in the index, oldest first
+_voice_data = OrderedDict() # {voice_name: audio bytes}, least recently used first
+_voice_data_size = 0 # Total bytes held in _voice_data
+_keyboard_cache = {"voices": None, "markup": None} # /voice keyboard for a get_available_voices() snapshot
+_inflight_saves: dict[str, tuple[str, asyncio.Task]] = {} # {voice_name: (file_unique_id, task saving it)}
+_default_voice_ensured = False # Set once ensure_default_voice() has run
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -40,36 +76,299 @@ logger = logging.getLogger(__name__)
 # --- Helper Functions ---
 
 # Dummy TTS using voice name and text
-async def tts(voice_name: str, text: str) -> BytesIO:
+def synthesize(voice_name: str, text: str, voice_data: bytes | None) -> bytes:
     """
-    Generates Text-to-Speech audio.
+    Generates Text-to-Speech audio (blocking).
     Replace with your actual TTS implementation.
-    This dummy version doesn't use the voice_name file.
+    This dummy version doesn't use voice_data (the contents of the voice file, or None if it doesn't exist).
     """
     logger.info(f"TTS called for voice '{voice_name}' with text: '{text[:30]}...'")
-    # In a real TTS, you'd load/use the actual voice file from VOICE_DIR / f"{voice_name}.wav"
-    return BytesIO(f"FAKE_AUDIO_FOR_{voice_name}".encode()) # Simple fake audio
+    return f"FAKE_AUDIO_FOR_{voice_name}".encode() # Simple fake audio
+
+async def tts(voice_name: str, text: str) -> BytesIO:
+    """Runs synthesize() in a worker thread so a slow synthesis doesn't block other chats."""
+    if voice_name == DEFAULT_VOICE_NAME:
+        await ensure_default_voice()
+    voice_data = await load_voice_data(voice_name)
+    audio = await asyncio.to_thread(synthesize, voice_name, text, voice_data)
+    # BytesIO shares the immutable bytes object instead of copying it until written to
+    return BytesIO(audio)
+
+def _is_wav_file(entry: os.DirEntry) -> bool:
+    # .wav or .WAV, checked on the raw name so no lowercased copy is made per file.
+    # A bare ".wav" would give an empty voice name, so it's skipped.
+    # DirEntry.is_file() uses the d_type from readdir, so no extra stat().
+    name = entry.name
+    return len(name) > len(_WAV_SUFFIX) and name.endswith(_WAV_SUFFIXES) and entry.is_file(follow_symlinks=False)
+
+def _voice_row(entry: os.DirEntry) -> tuple[str, str, int]:
+    return (entry.name[:-len(_WAV_SUFFIX)], entry.path, entry.stat(follow_symlinks=False).st_mtime_ns)
+
+def _scan_voices() -> list[tuple[str, str, int]]:
+    """Lists (voice name, file path, mtime) rows by scanning VOICE_DIR and its shard directories."""
+    voices = []
+    with os.scandir(VOICE_DIR) as it:
+        for e in it:
+            if _is_wav_file(e):
+                voices.append(_voice_row(e)) # Flat layout: pre-sharding or hand-added voices
+            elif len(e.name) == 2 and e.is_dir(follow_symlinks=False):
+                with os.scandir(e.path) as shard:
+                    voices.extend(_voice_row(f) for f in shard if _is_wav_file(f))
+    return voices
+
+def open_voice_index():
+    """Opens the SQLite voice index and fills it from VOICE_DIR."""
+    global _voice_index
+    # In-memory: the index is rebuilt from VOICE_DIR on every start, and writes never wait on disk
+    _voice_index = sqlite3.connect(":memory:")
+    _voice_index.execute("CREATE TABLE IF NOT EXISTS voices (name TEXT PRIMARY KEY, path TEXT NOT NULL, mtime INTEGER NOT NULL)")
+    # Initial scan; runs before the event loop starts, so it can block
+    signature = _voice_dir_signature()
+    _reindex_voices(_scan_voices())
+    _voices_cache.update(signature=signature, checked_at=time.monotonic())
+
+def _voice_dir_signature() -> dict[str, int]:
+    """Returns the mtimes of VOICE_DIR ("") and its shard directories.
+
+    Adding or removing a voice file changes the mtime of the directory it's in, and writing into an
+    existing shard doesn't touch VOICE_DIR itself, so all of them have to be compared.
+    """
+    signature = {"": os.stat(VOICE_DIR).st_mtime_ns}
+    with os.scandir(VOICE_DIR) as it:
+        for e in it:
+            if len(e.name) == 2 and e.is_dir(follow_symlinks=False):
+                signature[e.name] = e.stat(follow_symlinks=False).st_mtime_ns
+    return signature
+
+def _reindex_voices(voices: list[tuple[str, str, int]]):
+    """Replaces the index contents with the rows from a _scan_voices() pass."""
+    indexed = {name: (path, mtime) for name, path, mtime in _voice_index.execute("SELECT name, path, mtime FROM voices")}
+    with _voice_index:
+        _voice_index.execute("DELETE FROM voices")
+        _voice_index.executemany("INSERT OR REPLACE INTO voices (name, path, mtime) VALUES (?, ?, ?)", voices)
+    # Don't keep serving recordings whose files were deleted, moved or replaced
+    for name, path, mtime in voices:
+        if indexed.get(name, (path, mtime)) != (path, mtime):
+            drop_cached_voice_data(name)
+    names = {name for name, _, _ in voices}
+    for name in [n for n in _voice_data if n not in names]:
+        drop_cached_voice_data(name)
+
+def add_voice_to_index(voice_name: str, file_path: str, mtime: int, dir_mtimes: dict[str, int]):
+    """Records a voice we just saved, without rescanning VOICE_DIR."""
+    with _voice_index:
+        _voice_index.execute(
+            "INSERT OR REPLACE INTO voices (name, path, mtime) VALUES (?, ?, ?)", (voice_name, file_path, mtime)
+        )
+    # Our own write isn't a change made by hand, so it mustn't trigger a full rescan
+    if _voices_cache["signature"] is not None:
+        _voices_cache["signature"].update(dir_mtimes)
+    _voices_cache["voices"] = None
+    _missing_voices.pop(voice_name, None)
 
-def get_available_voices() -> list[str]:
-    """Returns a list of available voice names (without .wav extension)."""
-    if not VOICE_DIR.exists():
-        return []
+async def refresh_voice_index():
+    """Rescans VOICE_DIR if it changed, checking at most every VOICE_DIR_CHECK_INTERVAL seconds.
+
+    A change is detected from the mtimes of VOICE_DIR and its shard directories (e.g. a voice file
+    was added or deleted by hand). Both the check and the scan run in a worker thread.
+    """
+    now = time.monotonic()
+    if now - _voices_cache["checked_at"] < VOICE_DIR_CHECK_INTERVAL:
+        return
+    _voices_cache["checked_at"] = now # Set before awaiting so concurrent callers don't check too
     try:
-        # Only list files, ignore directories, case-insensitive .wav check
-        return [
-            f.stem
-            for f in VOICE_DIR.iterdir()
-            if f.is_file() and f.suffix.lower() == ".wav"
-        ]
+        signature = await asyncio.to_thread(_voice_dir_signature)
+        if signature == _voices_cache["signature"]:
+            return
+        voices = await asyncio.to_thread(_scan_voices)
+    except FileNotFoundError:
+        signature, voices = None, [] # VOICE_DIR is gone, so there are no voices
     except OSError as e:
         logger.error(f"Error listing voices in {VOICE_DIR}: {e}")
-        return []
+        return
+    _reindex_voices(voices)
+    _voices_cache.update(signature=signature, voices=None)
+    _missing_voices.clear() # A rescan may have found any of them
+
+async def get_available_voices() -> list[str]:
+    """Returns a list of available voice names (without .wav extension), sorted by name.
+
+    Names come from the SQLite index, and the list is cached until the index changes.
+    """
+    await refresh_voice_index()
+    if _voices_cache["voices"] is None:
+        _voices_cache["voices"] = [name for (name,) in _voice_index.execute("SELECT name FROM voices ORDER BY name")]
+    return _voices_cache["voices"]
+
+async def get_voice_file(voice_name: str) -> str | None:
+    """Returns the indexed file path of a voice, or None if there is no such voice."""
+    await refresh_voice_index() # Pick up voices added to or deleted from VOICE_DIR by hand
+    if voice_name in _missing_voices:
+        return None # e.g. the conceptual default voice, looked up on every TTS request without a selection
+    row = _voice_index.execute("SELECT path FROM voices WHERE name = ?", (voice_name,)).fetchone()
+    if row is None:
+        _missing_voices[voice_name] = None
+        if len(_missing_voices) > MISSING_VOICES_CACHE_SIZE:
+            del _missing_voices[next(iter(_missing_voices))] # Evict the oldest entry
+        return None
+    return row[0]
+
+async def voice_exists(voice_name: str) -> bool:
+    """Checks whether a voice is available, using the voice index."""
+    return await get_voice_file(voice_name) is not None
+
+def drop_cached_voice_data(voice_name: str):
+    """Removes a voice recording from memory, if it's cached."""
+    global _voice_data_size
+    data = _voice_data.pop(voice_name, None)
+    if data is not None:
+        _voice_data_size -= len(data)
+
+def cache_voice_data(voice_name: str, data: bytes):
+    """Keeps a voice recording in memory, evicting the least recently used ones to stay within VOICE_DATA_CACHE_BYTES."""
+    global _voice_data_size
+    drop_cached_voice_data(voice_name)
+    if len(data) > VOICE_DATA_CACHE_BYTES:
+        return # Would evict everything else and still not fit
+    _voice_data[voice_name] = data
+    _voice_data_size += len(data)
+    while _voice_data_size > VOICE_DATA_CACHE_BYTES:
+        _, evicted = _voice_data.popitem(last=False)
+        _voice_data_size -= len(evicted)
+
+def get_cached_voice_data(voice_name: str) -> bytes | None:
+    """Returns a voice recording from memory, or None if it isn't cached."""
+    data = _voice_data.get(voice_name)
+    if data is not None:
+        _voice_data.move_to_end(voice_name)
+    return data
+
+def voice_shard(voice_name: str) -> str:
+    """Returns the VOICE_DIR subdirectory a voice is stored in (first two hex chars of its name's hash)."""
+    # Keeps each directory small (256 buckets) so listing and lookups stay fast with many voices
+    # Not a security use, so this also works on FIPS-restricted builds
+    return hashlib.md5(voice_name.encode(), usedforsecurity=False).hexdigest()[:2]
+
+def voice_file_path(voice_name: str) -> str:
+    """Returns the path a voice's .wav file is saved to (in its shard directory), as a plain string."""
+    return f"{_VOICE_DIR_PREFIX}{voice_shard(voice_name)}{os.sep}{voice_name}{_WAV_SUFFIX}"
+
+def _read_file(file_path: str) -> bytes:
+    with open(file_path, "rb") as f:
+        return f.read()
+
+async def load_voice_data(voice_name: str) -> bytes | None:
+    """Returns a voice recording, reading it from disk only if it isn't cached yet."""
+    # Look the voice up first: that refreshes the index, which evicts recordings changed on disk
+    file_path = await get_voice_file(voice_name)
+    if file_path is None:
+        return None # e.g. the conceptual default voice
+    data = get_cached_voice_data(voice_name)
+    if data is None:
+        try:
+            data = await asyncio.to_thread(_read_file, file_path)
+        except FileNotFoundError:
+            return None # Deleted from VOICE_DIR since it was indexed
+        cache_voice_data(voice_name, data)
+    return data
+
+def set_pending_upload(user_data: dict, voice_name: str):
+    """Marks the user's next audio upload to be saved as voice_name, for PENDING_UPLOAD_TTL seconds."""
+    user_data[USER_DATA_AWAITING] = (voice_name, time.time() + PENDING_UPLOAD_TTL)
+
+def get_pending_upload(user_data: dict, pop: bool = False) -> str | None:
+    """Returns the voice name awaiting an upload from this user, or None if there is none or it expired."""
+    pending = user_data.pop(USER_DATA_AWAITING, None) if pop else user_data.get(USER_DATA_AWAITING)
+    if not pending:
+        return None
+    voice_name, expires_at = pending
+    if time.time() > expires_at:
+        user_data.pop(USER_DATA_AWAITING, None) # Abandoned /newvoice, clear it
+        return None
+    return voice_name
+
+def _write_file(file_path: str, data: bytes) -> tuple[int, dict[str, int]]:
+    try:
+        f = open(file_path, "wb")
+    except FileNotFoundError:
+        # Shard directory doesn't exist yet; only then pay for the mkdir
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        f = open(file_path, "wb")
+    with f:
+        f.write(data)
+    # The write changed the shard directory's mtime (and VOICE_DIR's, if the shard is new)
+    shard_dir = os.path.dirname(file_path)
+    dir_mtimes = {
+        "": os.stat(VOICE_DIR).st_mtime_ns,
+        os.path.basename(shard_dir): os.stat(shard_dir).st_mtime_ns,
+    }
+    return os.stat(file_path).st_mtime_ns, dir_mtimes
+
+async def write_voice_file(file_path: str, data: bytes) -> tuple[int, dict[str, int]]:
+    """Writes a voice file from a worker thread so disk I/O doesn't block the event loop.
+
+    Returns the file's mtime and the new mtimes of the directories the write touched, for add_voice_to_index().
+    """
+    return await asyncio.to_thread(_write_file, file_path, data)
+
+async def _download_voice(bot: Bot, file_id: str, voice_name: str) -> str:
+    """Downloads an uploaded recording and saves it as voice_name. Returns the saved path."""
+    new_file = await bot.get_file(file_id)
+
+    file_path = voice_file_path(voice_name) # Save with .wav extension
+
+    data = await new_file.download_as_bytearray()
+    mtime, dir_mtimes = await write_voice_file(file_path, data)
+    add_voice_to_index(voice_name, file_path, mtime, dir_mtimes)
+    # Cache an immutable copy: it's shared with synthesize() threads. Rebinding frees the bytearray.
+    data = bytes(data)
+    cache_voice_data(voice_name, data) # Lets TTS use the new voice without re-reading it from disk
+    return file_path
+
+async def save_voice(bot: Bot, file_id: str, file_unique_id: str, voice_name: str) -> str | None:
+    """Saves an uploaded recording as voice_name, joining the save if the same recording is already being saved.
+
+    Returns the saved path, or None if a different recording is already being saved under voice_name.
+    """
+    inflight = _inflight_saves.get(voice_name)
+    if inflight is None:
+        task = asyncio.create_task(_download_voice(bot, file_id, voice_name))
+        _inflight_saves[voice_name] = (file_unique_id, task)
+        task.add_done_callback(lambda _: _inflight_saves.pop(voice_name, None))
+    else:
+        inflight_unique_id, task = inflight
+        if inflight_unique_id != file_unique_id:
+            return None # Someone else is adding a voice with this name
+        logger.info(f"Voice '{voice_name}' is already being saved from this recording, waiting for that upload instead")
+    # Shield so one cancelled handler doesn't cancel the save for everyone waiting on it
+    return await asyncio.shield(task)
+
+async def ensure_default_voice():
+    """Creates a placeholder file for DEFAULT_VOICE_NAME the first time TTS needs it."""
+    global _default_voice_ensured
+    if _default_voice_ensured:
+        return
+    _default_voice_ensured = True # Set before awaiting so concurrent requests don't write it twice
+    # It's good practice to provide a default.wav if your DEFAULT_VOICE_NAME expects one
+    # For example, create a dummy one if it doesn't exist:
+    default_wav_path = voice_file_path(DEFAULT_VOICE_NAME)
+    if DEFAULT_VOICE_NAME != "default" and not await voice_exists(DEFAULT_VOICE_NAME): # Avoid creating for "default" if it's purely conceptual
+        try:
+            mtime, dir_mtimes = await write_voice_file(default_wav_path, b"DUMMY_DEFAULT_WAV_CONTENT") # placeholder
+            add_voice_to_index(DEFAULT_VOICE_NAME, default_wav_path, mtime, dir_mtimes)
+            logger.info(f"Created dummy default voice at {default_wav_path}")
+        except OSError as e:
+            logger.error(f"Could not create dummy default voice: {e}")
 
 def sanitize_voice_name(name: str) -> str:
     """Sanitizes a voice name to be filesystem-friendly."""
-    # Remove problematic characters, keep alphanumeric, underscore, hyphen
-    name = re.sub(r'[^\w\-]', '', name)
-    return name[:50] # Limit length
+    # Remove problematic characters, keep alphanumeric, underscore, hyphen; limit length
+    return _SANITIZE_RE.sub('', name)[:50]
+
+class WavDocumentFilter(filters.MessageFilter):
+    """Matches documents with a WAV mime type, using one set lookup per message."""
+    def filter(self, message) -> bool:
+        return message.document is not None and message.document.mime_type in WAV_MIME_TYPES
 
 # --- Command Handlers ---
 
@@ -81,22 +380,23 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def voice_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    voices = get_available_voices()
+    voices = await get_available_voices()
     if not voices:
         await update.message.reply_text(
             "No voices available. Use /newvoice <name> to add one."
         )
         return
 
-    keyboard = [
-        [InlineKeyboardButton(v, callback_data=f"{CALLBACK_PREFIX_VOICE}{v}")]
-        for v in voices
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Select a voice:", reply_markup=reply_markup)
+    # The voice list is only rebuilt when VOICE_DIR changes, so build its keyboard once per list
+    if _keyboard_cache["voices"] is not voices:
+        keyboard = [
+            [InlineKeyboardButton(v, callback_data=f"{CALLBACK_PREFIX_VOICE}{v}")]
+            for v in voices
+        ]
+        _keyboard_cache.update(voices=voices, markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text("Select a voice:", reply_markup=_keyboard_cache["markup"])
 
 async def newvoice_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
     if not context.args:
         await update.message.reply_text("Usage: /newvoice <voice_name>")
         return
@@ -108,13 +408,13 @@ async def newvoice_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Invalid voice name. Please use alphanumeric characters.")
         return
 
-    if (VOICE_DIR / f"{voice_name}.wav").exists():
+    if await voice_exists(voice_name):
         await update.message.reply_text(
             f"A voice named '{voice_name}' already exists. Choose a different name."
         )
         return
 
-    awaiting_voice_upload[user_id] = voice_name
+    set_pending_upload(context.user_data, voice_name)
     await update.message.reply_text(
         f"Okay, preparing to add new voice: '{voice_name}'.\n"
         f"Please send the voice recording now (as a voice message or a .wav audio file)."
@@ -126,12 +426,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer() # Acknowledge the button press
 
-    user_id = query.from_user.id
     data = query.data
 
     if data.startswith(CALLBACK_PREFIX_VOICE):
         voice_name = data[len(CALLBACK_PREFIX_VOICE):]
-        user_selected_voice[user_id] = voice_name
+        context.user_data[USER_DATA_VOICE] = voice_name
         await query.edit_message_text(text=f"Voice set to '{voice_name}'.")
     else:
         logger.warning(f"Unknown callback data: {data}")
@@ -144,9 +443,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     text = update.message.text
 
-    if user_id in awaiting_voice_upload:
+    voice_name_pending = get_pending_upload(context.user_data)
+    if voice_name_pending:
         # User might have typed text instead of sending audio after /newvoice
-        voice_name_pending = awaiting_voice_upload[user_id]
         await update.message.reply_text(
             f"I'm currently waiting for an audio file for the voice '{voice_name_pending}'.\n"
             "Please send a voice message or a .wav file. If you want to cancel, use /cancel (not implemented yet), or just send text after a while."
@@ -154,9 +453,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Determine voice: user's selection, or default, or first available
-    selected_voice = user_selected_voice.get(user_id)
+    selected_voice = context.user_data.get(USER_DATA_VOICE)
     if not selected_voice:
-        available_voices = get_available_voices()
+        available_voices = await get_available_voices()
         if available_voices:
             selected_voice = available_voices[0] # Use first available as a fallback
             logger.info(f"User {user_id} has no selection, using first available: {selected_voice}")
@@ -164,53 +463,62 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             selected_voice = DEFAULT_VOICE_NAME # Fallback to a conceptual default
             logger.info(f"User {user_id} has no selection, no voices available, using conceptual default: {selected_voice}")
 
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.RECORD_VOICE)
+    # Send the chat action while TTS runs instead of before it
+    action_task = asyncio.create_task(
+        context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.RECORD_VOICE)
+    )
     try:
         audio_data = await tts(selected_voice, text)
+        # Normally done by now; keeps the action from landing after the voice message.
+        # The action is only cosmetic, so its errors must not cost the user their voice reply.
+        await asyncio.gather(action_task, return_exceptions=True)
         await update.message.reply_voice(voice=audio_data, caption=f"Voice: {selected_voice}")
     except Exception as e:
         logger.error(f"Error during TTS or sending voice for user {user_id}: {e}")
         await update.message.reply_text("Sorry, I couldn't generate the speech for that text.")
+    finally:
+        # If TTS failed the action may still be pending; cancel it and retrieve its outcome either way
+        action_task.cancel()
+        await asyncio.gather(action_task, return_exceptions=True)
 
 async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
 
-    if user_id not in awaiting_voice_upload:
+    voice_name = get_pending_upload(context.user_data, pop=True) # Retrieve and remove from pending
+    if not voice_name:
         # If user sends a voice message without /newvoice command
         await update.message.reply_text(
             "If you want to add this as a new voice, please use the /newvoice <name> command first."
         )
         return
 
-    voice_name = awaiting_voice_upload.pop(user_id) # Retrieve and remove from pending
-    
     # Telegram voice messages are .oga (Opus). Documents can be .wav
     # We'll save it as .wav extension, but actual content might be oga.
     # A real TTS might need conversion (e.g. ffmpeg) if it only supports wav.
     
-    audio_message_part = update.message.voice or update.message.audio # handles both voice notes and audio files
-    
+    # Handles voice notes, audio files and .wav documents (non-WAV documents are filtered out in main())
+    audio_message_part = update.message.voice or update.message.audio or update.message.document
     if not audio_message_part:
         logger.warning(f"User {user_id} was awaiting voice upload for '{voice_name}' but sent no audio.")
         await update.message.reply_text("Something went wrong, I didn't receive an audio file. Please try /newvoice again.")
         return
 
-    # Check mime type if it's a document, to be more specific for .wav
-    if update.message.document and update.message.document.mime_type not in ["audio/wav", "audio/x-wav", "audio/wave"]:
-        logger.info(f"User {user_id} sent document for '{voice_name}' but not WAV: {update.message.document.mime_type}")
-        # You could reject here, or try to process it anyway. For now, we'll proceed.
-        # await update.message.reply_text("Please send a .wav file or a voice message.")
-        # awaiting_voice_upload[user_id] = voice_name # Put it back if rejecting
-        # return
+    # The name may have been taken since /newvoice was sent
+    if await voice_exists(voice_name):
+        await update.message.reply_text(
+            f"A voice named '{voice_name}' was added in the meantime. Please use /newvoice with a different name."
+        )
+        return
 
     try:
-        file_id = audio_message_part.file_id
-        new_file = await context.bot.get_file(file_id)
-        
-        file_path = VOICE_DIR / f"{voice_name}.wav" # Save with .wav extension
-        VOICE_DIR.mkdir(parents=True, exist_ok=True) # Ensure directory exists
-
-        await new_file.download_to_drive(custom_path=file_path)
+        file_path = await save_voice(
+            context.bot, audio_message_part.file_id, audio_message_part.file_unique_id, voice_name
+        )
+        if file_path is None:
+            await update.message.reply_text(
+                f"A voice named '{voice_name}' is already being added. Please use /newvoice with a different name."
+            )
+            return
         logger.info(f"New voice '{voice_name}' from user {user_id} saved to {file_path}")
         await update.message.reply_text(f"New voice '{voice_name}' added successfully!")
     except Exception as e:
@@ -218,28 +526,60 @@ async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
             f"Sorry, there was an error saving the voice '{voice_name}'. Please try again."
         )
-        # Potentially re-add to awaiting_voice_upload if it's a retryable error
-        # awaiting_voice_upload[user_id] = voice_name
+        # Potentially put it back in user_data if it's a retryable error
+        # set_pending_upload(context.user_data, voice_name)
+
+
+async def record_user_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stamps the user's latest activity (runs before every other handler)."""
+    if update.effective_user:
+        context.user_data[USER_DATA_LAST_SEEN] = time.time()
+
+
+# --- Background Jobs ---
+
+async def sweep_user_data(context: ContextTypes.DEFAULT_TYPE):
+    """Keeps per-user state bounded: drops idle users, caps the user count and clears expired uploads."""
+    application = context.application
+    now = time.time()
+    last_seen = {}
+    for user_id, user_data in list(application.user_data.items()):
+        seen = user_data.get(USER_DATA_LAST_SEEN, 0)
+        if now - seen > USER_DATA_IDLE_TTL:
+            application.drop_user_data(user_id)
+        else:
+            get_pending_upload(user_data) # Clears an abandoned /newvoice without waiting for the user
+            last_seen[user_id] = seen
+
+    excess = len(last_seen) - USER_DATA_MAX_USERS
+    if excess > 0:
+        for user_id in heapq.nsmallest(excess, last_seen, key=last_seen.get):
+            application.drop_user_data(user_id)
+        logger.info(f"Dropped state of {excess} least recently active users (over USER_DATA_MAX_USERS)")
 
 
 # --- Main Bot Setup ---
+async def close_voice_index(application: Application):
+    """Closes the voice index when the bot stops (Application.post_shutdown)."""
+    if _voice_index is not None:
+        _voice_index.close()
+
 def main():
     # Create voice directory if it doesn't exist
     VOICE_DIR.mkdir(parents=True, exist_ok=True)
-    
-    # It's good practice to provide a default.wav if your DEFAULT_VOICE_NAME expects one
-    # For example, create a dummy one if it doesn't exist:
-    default_wav_path = VOICE_DIR / f"{DEFAULT_VOICE_NAME}.wav"
-    if not default_wav_path.exists() and DEFAULT_VOICE_NAME != "default": # Avoid creating for "default" if it's purely conceptual
-        try:
-            with open(default_wav_path, "wb") as f:
-                f.write(b"DUMMY_DEFAULT_WAV_CONTENT") # placeholder
-            logger.info(f"Created dummy default voice at {default_wav_path}")
-        except OSError as e:
-            logger.error(f"Could not create dummy default voice: {e}")
-
+    open_voice_index()
+
+    # concurrent_updates lets a slow TTS request in one chat run alongside other chats' updates
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_shutdown(close_voice_index)
+        .build()
+    )
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Activity tracking, in its own group so it runs before (and alongside) the handlers below
+    application.add_handler(TypeHandler(Update, record_user_activity), group=-1)
 
     # Command Handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -251,9 +591,16 @@ def main():
 
     # Message Handlers
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    # Handle both direct voice messages and audio files sent as documents
-    application.add_handler(MessageHandler(filters.VOICE | filters.AUDIO, handle_audio))
-
+    # Handle voice messages, audio files and .wav files sent as documents.
+    # Other documents are rejected by the filter, before anything is downloaded.
+    application.add_handler(MessageHandler(filters.VOICE | filters.AUDIO | WavDocumentFilter(), handle_audio))
+
+    # Background Jobs
+    if application.job_queue is None:
+        raise RuntimeError('JobQueue not available, install "python-telegram-bot[job-queue]"')
+    application.job_queue.run_repeating(
+        sweep_user_data, interval=USER_DATA_SWEEP_INTERVAL, first=USER_DATA_SWEEP_INTERVAL
+    )
 
     logger.info("Bot starting...")
     application.run_polling()